@@ -2,18 +2,30 @@ import streamlit as st
 import yfinance as yf
 import pandas as pd
 import matplotlib.pyplot as plt
+import matplotlib.dates as mdates
+from matplotlib.collections import LineCollection
+from matplotlib.colors import to_rgba
+from matplotlib.figure import Figure
 from matplotlib.lines import Line2D
 import numpy as np
 import time
 import warnings
-
-# --- 1. 定数と共通設定 (変更なし) ---
+import hashlib
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+
+# --- 1. 定数と共通設定 ---
 warnings.filterwarnings('ignore', category=UserWarning)
-try:
-    plt.rcParams['font.family'] = 'IPAGothic'
-except RuntimeError:
-    st.warning("日本語フォント（IPAGothic）が見つかりません。正しく表示されない可能性があります。")
-plt.rcParams['axes.unicode_minus'] = False
+# ページスクリプトは再実行のたびに評価されるが、matplotlib の設定はプロセス内で保持されるため初回のみ設定する
+if plt.rcParams['font.family'] != ['IPAGothic']:
+    try:
+        plt.rcParams['font.family'] = 'IPAGothic'
+    except RuntimeError:
+        st.warning("日本語フォント（IPAGothic）が見つかりません。正しく表示されない可能性があります。")
+    plt.rcParams['axes.unicode_minus'] = False
 
 # --- 日本市場の定義 (変更なし) ---
 JP_BENCHMARK_TICKER = '1306.T' # TOPIX連動ETF
@@ -62,8 +74,15 @@ US_ASSET_NAME_MAP = {
 # 全資産の定義を統合 (変更なし)
 ALL_JP_TICKERS = list(set([JP_BENCHMARK_TICKER] + JP_SECTOR_TICKERS + JP_THEMATIC_TICKERS))
 ALL_US_TICKERS = list(set([US_BENCHMARK_TICKER] + US_SECTOR_TICKERS + US_THEMATIC_TICKERS))
+# 市場の判定（所属チェック）用
+ALL_JP_TICKERS_SET = frozenset(ALL_JP_TICKERS)
+ALL_US_TICKERS_SET = frozenset(ALL_US_TICKERS)
 ALL_ASSETS_NAME_MAP = {**JP_ASSET_NAME_MAP, **US_ASSET_NAME_MAP}
 
+# 線の濃さに反映できる指標（日中足VWAP系は5分足の取得が重いため、選択されたときだけ計算する）
+DAILY_METRICS = ['RSI (日足14)', '出来高急増率(日足20)']
+VWAP_METRICS = ['VWAP +1σ維持率(5分足)', 'VWAP 0σ維持率(5分足)', 'VWAP -1σ維持率(5分足)']
+
 # --- ★変更点①: Session State の初期化 ---
 # アプリのセッション内で日足データを保持するための領域を確保
 if 'daily_data' not in st.session_state:
@@ -71,68 +90,300 @@ if 'daily_data' not in st.session_state:
     st.session_state.loaded_tickers = []
 
 
-# --- 2. 自作の指標計算関数 (変更なし) ---
-def calculate_rsi(series: pd.Series, length: int = 14) -> pd.Series:
-    delta = series.diff()
-    gain = delta.where(delta > 0, 0).ewm(alpha=1/length, adjust=False).mean()
-    loss = -delta.where(delta < 0, 0).ewm(alpha=1/length, adjust=False).mean()
-    rs = gain / loss
+# --- 2. 自作の指標計算関数 ---
+def calculate_rsi(prices: pd.DataFrame, length: int = 14) -> pd.DataFrame:
+    """全銘柄(列)のRSIをまとめて計算する"""
+    values = prices.to_numpy(dtype=np.float64)
+    delta = np.diff(values, axis=0, prepend=np.nan)
+    # 上昇幅・下落幅を横に並べる（差分が欠損の日は 0 として扱う）
+    gain_loss = np.concatenate([np.where(delta > 0, delta, 0.0), np.where(delta < 0, -delta, 0.0)], axis=1)
+    # ewm(alpha=1/length, adjust=False).mean() と同じ漸化式を、全列まとめて日付方向に1回だけ回す
+    # (入力に欠損がないため pandas の汎用的な ewm を通す必要がない)
+    alpha = 1 / length
+    smoothed = np.empty_like(gain_loss)
+    smoothed[:1] = gain_loss[:1]
+    for i in range(1, len(gain_loss)):
+        smoothed[i] = (1 - alpha) * smoothed[i - 1] + alpha * gain_loss[i]
+    n_columns = values.shape[1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rs = smoothed[:, :n_columns] / smoothed[:, n_columns:]
     rsi = 100 - (100 / (1 + rs))
-    return rsi
+    return pd.DataFrame(rsi, index=prices.index, columns=prices.columns)
+
+# --- 価格データのディスクキャッシュ ---
+# 確定済みの月の日足・5分足は (銘柄, 足種, 月) ごとに Parquet で保存し、セッションやアプリの再起動をまたいで再利用する
+YF_CACHE_DIR = Path('.cache') / 'yfinance'
+# 調整後価格（分配金・分割の反映）の変化を検出するため、キャッシュ済み期間と重ねて取得する日数
+CACHE_OVERLAP_DAYS = 14
+# 5分足は直近60日分しか取得できないため、日付の区切りの差を見込んで59日前までに限って要求する
+INTRADAY_MAX_HISTORY_DAYS = 59
+
+def _cache_path(ticker, interval, month_start):
+    key = hashlib.md5(f"{ticker}|{interval}|{month_start:%Y-%m}".encode()).hexdigest()
+    return YF_CACHE_DIR / f"{key}.parquet"
+
+def _local_times(index):
+    """tz 付きの時刻（5分足）は取引所の現地時刻のまま tz を外し、tz なしの月・期間の境界と比べられるようにする"""
+    return index.tz_localize(None) if getattr(index, 'tz', None) is not None else index
+
+def _read_cache(path):
+    """キャッシュを読み込む（ない・読めない場合は None。読めないファイルは削除し、その月を取り直させる）"""
+    try:
+        return pd.read_parquet(path)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        try:
+            path.unlink(missing_ok=True)
+        except OSError:
+            pass
+        return None
+
+def _write_cache(df, path):
+    # 書きかけのファイルを他のセッションが読まないよう、同じフォルダの一時ファイルに書いてから置き換える
+    tmp_path = None
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+        os.close(fd)
+        df.to_parquet(tmp_path, compression='zstd')
+        os.replace(tmp_path, path)
+    except (OSError, ValueError):
+        # キャッシュに書けなくても表示には影響させない
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+def download_with_file_cache(tickers, start, end, interval='1d', columns=None, max_history_days=None, **kwargs):
+    """
+    yf.download を月単位のファイルキャッシュ越しに呼び出す（戻り値は group_by='column' と同じ形）。
+    キャッシュ済みの月は読み込みのみとし、銘柄ごとにキャッシュにない最も古い月から end までを取得する
+    （取得開始月が同じ銘柄は1回の yf.download にまとめる）。
+    columns を指定した場合は、取得直後にその列だけに絞ってから保存・結合する。
+    月のファイルはその月全体を取得できた場合のみ保存する（end が月の途中なら、その月は次回も取得する）。
+    max_history_days を指定した場合は、今日からその日数より前を yf.download に要求しない（5分足の取得制限）。
+    その場合、取得できる範囲より前に終わる月はキャッシュの対象にせず、範囲の始まりを含む月は取得できた分で保存する。
+    """
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    today = pd.Timestamp.today().normalize()
+    current_month = today.replace(day=1)
+    earliest = today - pd.Timedelta(days=max_history_days) if max_history_days is not None else None
+    months = pd.date_range(start.replace(day=1), end - pd.Timedelta(days=1), freq='MS')
+    # 当月はまだ確定していないため、キャッシュの対象は前月まで
+    past_months = [m for m in months if m < current_month]
+    if earliest is not None:
+        # 取得できる範囲より前に終わる月はもう取得できないため、欠けた月として取得開始月を固定させない
+        past_months = [m for m in past_months if m + pd.offsets.MonthBegin(1) > earliest]
+
+    # 銘柄ごとの取得開始月（市場を切り替えた場合なども、キャッシュのない銘柄の分だけを取得する）
+    # ファイルがあっても読めない月はキャッシュなしとして扱う
+    fetch_from_by_ticker, cached_chunks_by_ticker = {}, {}
+    for ticker in tickers:
+        chunks = {m: _read_cache(_cache_path(ticker, interval, m)) for m in past_months}
+        missing = [m for m, chunk in chunks.items() if chunk is None]
+        if missing:
+            fetch_from = missing[0]
+        elif end > current_month:
+            fetch_from = current_month
+        else:
+            fetch_from = None
+        fetch_from_by_ticker[ticker] = fetch_from
+        cached_chunks_by_ticker[ticker] = {m: chunk for m, chunk in chunks.items() if fetch_from is None or m < fetch_from}
+
+    fresh_frames, covered_from = {}, {}
+    for fetch_from in {f for f in fetch_from_by_ticker.values() if f is not None}:
+        group = [t for t in tickers if fetch_from_by_ticker[t] == fetch_from]
+        has_cached_before = fetch_from > months[0]
+        download_start = fetch_from - pd.Timedelta(days=CACHE_OVERLAP_DAYS) if has_cached_before else fetch_from
+        clamped = earliest is not None and download_start < earliest
+        if clamped:
+            download_start = earliest
+        if download_start >= end:
+            continue
+        # この取得で初めから終わりまで揃う最初の月（これより前の月は保存しない）
+        # 取得制限で切り詰めた場合、範囲の始まりを含む月はそれより前をもう取得できないため、取得できた分で揃ったとみなす
+        covered_from[fetch_from] = max(fetch_from, earliest.replace(day=1) if clamped else download_start)
+        # 銘柄が1つでも (銘柄, 価格) の2段の列になるよう明示する
+        fresh = yf.download(group, start=download_start, end=end, interval=interval, group_by='ticker', multi_level_index=True, **kwargs)
+        if isinstance(fresh.columns, pd.MultiIndex):
+            for ticker in set(fresh.columns.get_level_values(0)):
+                fresh_t = fresh[ticker] if columns is None else fresh[ticker][columns]
+                fresh_frames[ticker] = fresh_t.dropna(how='all')
+
+    frames = {}
+    for ticker in tickers:
+        fetch_from = fetch_from_by_ticker[ticker]
+        fresh_t = fresh_frames.get(ticker, pd.DataFrame())
+        cached_chunks = cached_chunks_by_ticker[ticker]
+        cached_t = pd.concat(cached_chunks.values()) if cached_chunks else pd.DataFrame()
+
+        if not cached_t.empty and not fresh_t.empty:
+            overlap = cached_t.index.intersection(fresh_t.index)
+            if len(overlap) > 0:
+                # 重なった日の終値が食い違う場合は調整後価格が更新されているので、キャッシュ側を補正して保存し直す
+                # 価格の列（5分足の高値・安値など）はすべて同じ比率で合わせ、列どうしの関係を崩さない
+                ratio = fresh_t.at[overlap[-1], 'Close'] / cached_t.at[overlap[-1], 'Close']
+                if pd.notna(ratio) and not np.isclose(ratio, 1.0):
+                    rescale = {column: ratio for column in ('Open', 'High', 'Low', 'Close') if column in cached_t.columns}
+                    # 分割の場合は出来高も遡って調整されるため、重なった期間の出来高の比で合わせる（分配金では比はほぼ1）
+                    if 'Volume' in cached_t.columns and 'Volume' in fresh_t.columns:
+                        volume_ratio = fresh_t.loc[overlap, 'Volume'].sum() / cached_t.loc[overlap, 'Volume'].sum()
+                        if np.isfinite(volume_ratio) and volume_ratio > 0 and not np.isclose(volume_ratio, 1.0, rtol=0.05):
+                            rescale['Volume'] = volume_ratio
+                    for m, chunk in cached_chunks.items():
+                        for column, factor in rescale.items():
+                            chunk[column] *= factor
+                        _write_cache(chunk, _cache_path(ticker, interval, m))
+                    for column, factor in rescale.items():
+                        cached_t[column] *= factor
+            cached_t = cached_t[cached_t.index < fresh_t.index[0]]
+
+        if not fresh_t.empty:
+            fresh_times = _local_times(fresh_t.index)
+            for m in past_months:
+                month_end = m + pd.offsets.MonthBegin(1)
+                # 途中までしか取得していない月を保存すると、以降は欠けたまま確定済みとして扱われてしまう
+                if m >= covered_from[fetch_from] and month_end <= end:
+                    _write_cache(fresh_t[(fresh_times >= m) & (fresh_times < month_end)], _cache_path(ticker, interval, m))
+
+        combined = pd.concat([cached_t, fresh_t]) if not cached_t.empty else fresh_t
+        if not combined.empty:
+            frames[ticker] = combined
+
+    if not frames:
+        return pd.DataFrame()
+    data = pd.concat(frames, axis=1, sort=True, names=['Ticker', 'Price'])
+    data = data.swaplevel(0, 1, axis=1).sort_index(axis=1, level=0)
+    data_times = _local_times(data.index)
+    return data[(data_times >= start) & (data_times < end)]
 
 # --- ★変更点②: データ取得と計算ロジックの刷新 ---
 
 # 日中足データは重いため、個別の関数に分離しキャッシュ
-@st.cache_data(ttl=3600)
+# 日足の取得と並行して別スレッドから呼ばれるため、画面への警告表示は呼び出し側で行う
+@st.cache_data(ttl=3600, show_spinner=False)
 def get_intraday_data_and_vwap(start_date, end_date, target_tickers):
-    """指定された期間の日中足データを取得し、VWAP関連指標を計算する"""
-    strength_dfs_vwap = {}
-    chart_index = pd.date_range(start=start_date, end=end_date, freq='B')
+    """指定された期間の日中足データを取得し、VWAP関連指標（列は (指標, 銘柄)。なければNone）とエラーメッセージ(なければNone)を返す"""
+    vwap_wide = None
     try:
-        df_intraday = yf.download(
+        # 確定済みの月は日足と同じファイルキャッシュから読み、VWAP の計算に使う高値・安値・終値・出来高だけを取得・保存する
+        df_intraday = download_with_file_cache(
             target_tickers,
             start=start_date,
             end=end_date,
             interval='5m',
-            group_by='ticker',
+            columns=['High', 'Low', 'Close', 'Volume'],
+            max_history_days=INTRADAY_MAX_HISTORY_DAYS,
             progress=False,
             timeout=120
         )
-        if not df_intraday.empty and isinstance(df_intraday.columns, pd.MultiIndex):
-            daily_results = []
-            for ticker in target_tickers:
-                if ticker in df_intraday.columns:
-                    ticker_df = df_intraday[ticker].copy().dropna()
-                    if not ticker_df.empty:
-                        for date, df_day in ticker_df.groupby(lambda x: x.date()):
-                            total_intervals = len(df_day)
-                            if total_intervals < 1: continue
-                            df_day['TP'] = (df_day['High'] + df_day['Low'] + df_day['Close']) / 3
-                            df_day['TPxV'] = df_day['TP'] * df_day['Volume']
-                            df_day['VWAP'] = df_day['TPxV'].cumsum() / df_day['Volume'].cumsum()
-                            df_day['Std'] = df_day['TP'].expanding().std().fillna(0)
-                            daily_results.append({
-                                'Date': pd.to_datetime(date), 'Ticker': ticker,
-                                'VWAP +1σ維持率(5分足)': ((df_day['Low'] >= (df_day['VWAP'] + df_day['Std'])).sum() / total_intervals) * 100,
-                                'VWAP 0σ維持率(5分足)': ((df_day['Low'] >= df_day['VWAP']).sum() / total_intervals) * 100,
-                                'VWAP -1σ維持率(5分足)': ((df_day['Low'] >= (df_day['VWAP'] - df_day['Std'])).sum() / total_intervals) * 100
-                            })
-            if daily_results:
-                df_vwap_results = pd.DataFrame(daily_results)
-                for metric in ['VWAP +1σ維持率(5分足)', 'VWAP 0σ維持率(5分足)', 'VWAP -1σ維持率(5分足)']:
-                    strength_dfs_vwap[metric] = df_vwap_results.pivot(
-                        index='Date', columns='Ticker', values=metric
-                    ).reindex(chart_index, method='ffill')
+        if not df_intraday.empty:
+            # (5分足, 銘柄) の縦長データにまとめ、VWAP等は (銘柄, 日付) ごとの累積計算として一度に行う
+            df_long = df_intraday.stack(level='Ticker').dropna()
+            if not df_long.empty:
+                bar_times = df_long.index.get_level_values(0)
+                # 日付は取引所の現地時間で区切る
+                days = bar_times.tz_localize(None).normalize()
+                group_keys = [df_long.index.get_level_values(1), days]
+                # (銘柄, 日付) の組は一度だけ整数のグループ番号に変換し、累積計算ではそれを使い回す
+                group_ids = df_long.groupby(group_keys, sort=False).ngroup()
+                tp = (df_long['High'] + df_long['Low'] + df_long['Close']) / 3
+                volume = df_long['Volume']
+                # 標準偏差は各日の最初の値を引いてから二乗和を取ることで、価格水準による桁落ちを防ぐ
+                shifted = tp - tp.groupby(group_ids, sort=False).transform('first')
+                # VWAP と当日の累積標準偏差（標本）に必要な累積和は、1回のグループ別 cumsum でまとめて求める
+                cums = pd.DataFrame({
+                    'n': 1.0, 'tpv': tp * volume, 'volume': volume, 'sum': shifted, 'sq_sum': shifted * shifted
+                }).groupby(group_ids, sort=False).cumsum()
+                n = cums['n']
+                vwap = cums['tpv'] / cums['volume']
+                variance = (cums['sq_sum'] - cums['sum'] * cums['sum'] / n) / np.maximum(n - 1, 1)
+                std = np.sqrt(np.maximum(variance, 0))
+                # +1σ・0σ・-1σ の3本のバンドを1つの配列にして、安値との比較を一度に行う
+                bands = vwap.to_numpy()[:, None] + std.to_numpy()[:, None] * np.array([1.0, 0.0, -1.0])
+                maintained = pd.DataFrame(
+                    df_long['Low'].to_numpy()[:, None] >= bands,
+                    index=df_long.index,
+                    columns=VWAP_METRICS
+                )
+                ratios = (maintained.groupby(group_keys).mean() * 100).rename_axis(['Ticker', 'Date'])
+                # 3指標まとめて1回で (日付 × (指標, 銘柄)) に展開する
+                vwap_wide = ratios.unstack('Ticker')
     except Exception as e:
-        st.warning(f"日中足VWAP指標の計算に失敗しました: {e}")
-    return strength_dfs_vwap
-
-
-def get_data_and_indicators(period_option, start_date, end_date, target_tickers):
+        return vwap_wide, str(e)
+    return vwap_wide, None
+
+
+# 「年初来」などは再実行のたびに日足を取り直すため、同じ期間・銘柄の取得結果は1時間メモリ上で再利用する
+# （確定済みの月はファイルキャッシュにあるので、期限切れ後に問い合わせるのは当月分のみ）
+@st.cache_data(ttl=3600, show_spinner=False)
+def get_daily_data(start_date, end_date, target_tickers):
+    """日足の終値・出来高を取得する（列は銘柄が1つでも常に (Close/Volume, 銘柄) の MultiIndex）"""
+    df_daily = download_with_file_cache(
+        target_tickers,
+        start=start_date,
+        end=end_date,
+        columns=['Close', 'Volume'],
+        auto_adjust=True,
+        progress=False,
+        threads=True,
+        timeout=60
+    )
+    if df_daily.empty:
+        # yfinance は取得に失敗しても例外を出さずに空で返すため、ここで例外にして失敗結果をキャッシュさせない
+        raise ValueError("日足データを取得できませんでした。")
+    # 以降の計算で使うのは終値と出来高のみ（全列を保存した古いキャッシュが混ざっても列を揃える）
+    # セッションに保持し続けるデータなので、表示に十分な精度の float32 にしてメモリを半分にする
+    return df_daily[['Close', 'Volume']].astype(np.float32)
+
+
+# 銘柄の選択や表示指標の切り替えによる再実行では日足データが変わらないため、
+# 同じ日足データ・銘柄に対する指標の計算結果を使い回す
+@st.cache_data(max_entries=8, show_spinner=False)
+def calculate_daily_indicators(df_daily_full, target_tickers):
+    """日足データから RSI と出来高急増率を計算し、{指標名: DataFrame} で返す"""
+    indicator_dfs = {}
+    close_prices_full = df_daily_full['Close']
+    volume_data_full = df_daily_full['Volume']
+    # 取得できた銘柄の集合は一度だけ作り、以降の所属チェックに使う
+    daily_tickers = set(df_daily_full.columns.get_level_values(1))
+    available_tickers = [ticker for ticker in target_tickers if ticker in daily_tickers]
+    if available_tickers:
+        indicator_dfs['RSI (日足14)'] = calculate_rsi(close_prices_full[available_tickers])
+
+    # 出来高データが全くない銘柄は除き、残りの全銘柄を1回の rolling でまとめて計算する
+    volume_data = volume_data_full[available_tickers].dropna(axis=1, how='all')
+    if not volume_data.empty:
+        volume_ma20 = volume_data.rolling(window=20).mean()
+        volume_df = (volume_data / volume_ma20) * 100
+        volume_clipped = volume_df.clip(50, 250)
+        volume_normalized = (volume_clipped - 50) / 200 * 100
+        indicator_dfs['出来高急増率(日足20)'] = volume_normalized
+    return indicator_dfs
+
+
+def get_data_and_indicators(period_option, start_date, end_date, target_tickers, include_vwap=True):
     """
     データ取得と指標計算のメイン関数。
     日足データは session_state を活用してキャッシュし、高速化を図る。
+    日中足VWAP指標は include_vwap が True のときだけ取得・計算する。
     """
+    intraday_futures = []
+    if include_vwap:
+        # 日中足の取得は日足と独立しているため、日足の取得・計算中に別スレッドで進めておく
+        # (途中で return しても取得結果は st.cache_data に残るので無駄にならない)
+        # 日中足は市場ごとに取得・キャッシュする。日米比較でも日本・米国それぞれのキャッシュを再利用でき、
+        # 日付の区切りも各市場の現地時間になる
+        market_ticker_groups = [
+            group for group in ([t for t in target_tickers if t in ALL_JP_TICKERS_SET], [t for t in target_tickers if t not in ALL_JP_TICKERS_SET])
+            if group
+        ]
+        executor = ThreadPoolExecutor(max_workers=len(market_ticker_groups) or 1)
+        intraday_futures = [executor.submit(get_intraday_data_and_vwap, start_date, end_date, group) for group in market_ticker_groups]
+        executor.shutdown(wait=False)
+
     # 市場が変更されたら日足キャッシュをクリア
     if set(target_tickers) != set(st.session_state.loaded_tickers):
         st.session_state.daily_data = pd.DataFrame()
@@ -157,17 +408,12 @@ def get_data_and_indicators(period_option, start_date, end_date, target_tickers)
             try:
                 # RSI等の計算のために60日余分に取得
                 fetch_start_with_margin = fetch_start - pd.DateOffset(days=60)
-                df_daily_full = yf.download(
-                    target_tickers,
-                    start=fetch_start_with_margin,
-                    end=fetch_end,
-                    auto_adjust=True,
-                    progress=False,
-                    timeout=60
-                )
-                if df_daily_full.empty:
-                     st.error("日足データを取得できませんでした。")
-                     return None, None
+                df_daily_full = get_daily_data(fetch_start_with_margin, fetch_end, target_tickers)
+                # 一部の銘柄が取得できなかった場合は取得できた分で表示し、次の再実行で取り直せるよう
+                # 結果をキャッシュから外して、セッションのデータも未取得扱いにする
+                if not set(target_tickers) <= set(df_daily_full.columns.get_level_values(1)):
+                    get_daily_data.clear(fetch_start_with_margin, fetch_end, target_tickers)
+                    st.session_state.loaded_tickers = []
                 # 取得したデータをセッションに保存
                 st.session_state.daily_data = df_daily_full
             except Exception as e:
@@ -181,93 +427,159 @@ def get_data_and_indicators(period_option, start_date, end_date, target_tickers)
         st.error("表示するデータがありません。")
         return None, None
 
-    # ティッカーが1つの場合でもMultiIndexに変換
-    if not isinstance(df_daily_full.columns, pd.MultiIndex):
-        df_daily_full.columns = pd.MultiIndex.from_product([df_daily_full.columns, target_tickers])
-
-    # 表示期間でデータをスライス
-    df_daily_chart = df_daily_full.loc[start_date:end_date].copy()
-    if df_daily_chart.empty:
+    # 表示期間でデータをスライス（以降は終値しか使わないため、終値だけをコピーせずに切り出す）
+    close_prices_chart = df_daily_full['Close'].loc[start_date:end_date]
+    if close_prices_chart.empty:
         st.error("選択された期間にデータがありません。期間を変更してください。")
         return None, None
 
     strength_dfs = {}
-    chart_index = pd.date_range(start=start_date, end=end_date, freq='B')
+    # 実際の取引日を基準の日付軸とする（営業日カレンダーだと祝日に余計な行ができるため）
+    chart_index = close_prices_chart.index
 
     # --- 日足指標の計算 ---
     try:
-        close_prices_full = df_daily_full['Close']
-        volume_data_full = df_daily_full['Volume']
-        all_rsi_series = [calculate_rsi(close_prices_full[ticker]).rename(ticker) for ticker in target_tickers if ticker in close_prices_full]
-        if all_rsi_series:
-            strength_dfs['RSI (日足14)'] = pd.concat(all_rsi_series, axis=1).reindex(chart_index, method='ffill')
-
-        all_volume_series = []
-        for ticker in target_tickers:
-            if ticker in volume_data_full and volume_data_full[ticker].notna().any():
-                volume_ma20 = volume_data_full[ticker].rolling(window=20).mean()
-                volume_surge = (volume_data_full[ticker] / volume_ma20) * 100
-                all_volume_series.append(volume_surge.rename(ticker))
-        if all_volume_series:
-            volume_df = pd.concat(all_volume_series, axis=1)
-            volume_clipped = np.clip(volume_df, 50, 250)
-            volume_normalized = (volume_clipped - 50) / 200 * 100
-            strength_dfs['出来高急増率(日足20)'] = volume_normalized.reindex(chart_index, method='ffill')
+        strength_dfs.update(calculate_daily_indicators(df_daily_full, target_tickers))
     except Exception as e:
         st.warning(f"日足指標の計算中にエラーが発生しました: {e}")
 
-    # --- 日中足VWAP指標の計算 (キャッシュされた関数を呼び出し) ---
-    vwap_strength_dfs = get_intraday_data_and_vwap(start_date, end_date, target_tickers)
-    strength_dfs.update(vwap_strength_dfs)
+    # 日足の指標を表示期間の取引日に揃える（日足データと同じ日付を持つため、前方埋めは不要）
+    # 指標の計算は float64 で行い、描画・表示に渡す段階で float32 にしてデータ量を半分にする
+    strength_dfs = {metric: df.reindex(chart_index).astype(np.float32) for metric, df in strength_dfs.items()}
+
+    # --- 日中足VWAP指標の計算 (別スレッドで進めていた市場ごとの結果を受け取り、銘柄方向に結合する) ---
+    vwap_parts = []
+    for future in intraday_futures:
+        market_vwap_wide, vwap_error = future.result()
+        if vwap_error:
+            st.warning(f"日中足VWAP指標の計算に失敗しました: {vwap_error}")
+        if market_vwap_wide is not None:
+            vwap_parts.append(market_vwap_wide)
+    if vwap_parts:
+        vwap_wide = pd.concat(vwap_parts, axis=1, sort=True) if len(vwap_parts) > 1 else vwap_parts[0]
+        # 3指標まとめて1回で表示期間の取引日に揃え（日中足のない日は直前の値で埋める）、指標ごとに分ける
+        vwap_wide = vwap_wide.reindex(chart_index, method='ffill').astype(np.float32)
+        strength_dfs.update({metric: vwap_wide[metric] for metric in VWAP_METRICS})
 
     # --- 戻り値の準備 ---
-    close_prices_chart = df_daily_chart['Close']
-    valid_tickers = [t for t in target_tickers if t in close_prices_chart.columns and close_prices_chart[t].notna().sum() > 1]
+    # 有効な値の数は全銘柄まとめて一度に数える
+    valid_counts = close_prices_chart.notna().sum().to_dict()
+    valid_tickers = [t for t in target_tickers if valid_counts.get(t, 0) > 1]
     if not valid_tickers:
         st.error("選択された期間に有効な価格データを持つ銘柄がありません。")
         return None, None
 
     close_prices_valid = close_prices_chart[valid_tickers]
-    return close_prices_valid, strength_dfs
-
-
-# --- 4. グラフ描画関数 (変更なし) ---
-def create_chart(performance_df, strength_dfs, final_absolute_performance,
+    # 呼び出し側で必要なのは累積リターンのみのため、ここで一度だけ計算して返す
+    # ((1 + pct_change().fillna(0)).cumprod() - 1 と同じ計算を、中間の DataFrame を作らず NumPy 配列上で行う)
+    prices = close_prices_valid.to_numpy(dtype=np.float64)
+    growth = np.ones_like(prices)
+    np.divide(prices[1:], prices[:-1], out=growth[1:])
+    growth[np.isnan(growth)] = 1.0  # 前日または当日の値がない日は変化なしとみなす
+    cumulative = np.cumprod(growth, axis=0)
+    cumulative -= 1.0
+    cumulative_returns = pd.DataFrame(cumulative.astype(np.float32), index=close_prices_valid.index, columns=close_prices_valid.columns)
+    return cumulative_returns, strength_dfs
+
+
+# --- 4. グラフ描画関数 ---
+# 色と凡例は市場の銘柄構成・並び順・選択状態にのみ依存するため、再実行ごとに作り直さずキャッシュする
+@lru_cache(maxsize=8)
+def get_ticker_colors(market_tickers):
+    """市場の銘柄タプルから 銘柄→色(RGBA) の対応表を作成する"""
+    cmap = plt.get_cmap('nipy_spectral', len(market_tickers))
+    # カラーマップは銘柄数分まとめて一度に引く
+    rgba = cmap(np.arange(len(market_tickers)))
+    return {ticker: tuple(rgba[i]) for i, ticker in enumerate(market_tickers)}
+
+
+@lru_cache(maxsize=64)
+def build_legend_elements(sorted_tickers, selected_tickers, market_tickers, has_month_separator):
+    """凡例用の Line2D 要素を作成する（引数はすべてハッシュ可能な tuple / frozenset）"""
+    ticker_colors = get_ticker_colors(market_tickers)
+    legend_elements = [Line2D([0], [0], color=ticker_colors.get(ticker, 'gray'), lw=4, label=f"{i+1}. {ALL_ASSETS_NAME_MAP.get(ticker, ticker)} ({ticker})") for i, ticker in enumerate(sorted_tickers) if ticker in selected_tickers]
+    legend_elements.append(Line2D([0], [0], color='red', linestyle='--', lw=1.5, label='米国SQ日 (第3金曜)'))
+    legend_elements.append(Line2D([0], [0], color='blue', linestyle='--', lw=1.5, label='日本SQ日 (第2金曜)'))
+    if has_month_separator: legend_elements.append(Line2D([0], [0], color='gray', linestyle=':', lw=2, label='月の区切り'))
+    return tuple(legend_elements)
+
+
+@lru_cache(maxsize=32)
+def get_sq_dates(start_date, end_date, freq):
+    """期間内のSQ日（米国: WOM-3FRI、日本: WOM-2FRI）"""
+    return pd.date_range(start=start_date, end=end_date, freq=freq)
+
+def strength_to_alpha(strength: np.ndarray, is_rsi: bool) -> np.ndarray:
+    """指標値の配列を線の濃さ(α: 0.15〜1.0)に変換する（引数の配列をそのまま書き換えて返す）"""
+    strength[np.isnan(strength)] = 50
+    if is_rsi:
+        # RSI は 50 からの乖離を強さとみなす
+        strength -= 50
+        np.abs(strength, out=strength)
+        strength *= 2
+    np.clip(strength, 0, 100, out=strength)
+    strength /= 100
+    strength *= 0.85
+    strength += 0.15
+    return strength
+
+# 銘柄の選択や指標の切り替えで以前と同じ組み合わせに戻った場合は、描画済みの図を再利用する
+# (st.cache_data は呼び出しごとに図の複製を返すため、複数セッションで同じ Figure を同時に描画することはない)
+@st.cache_data(max_entries=16, show_spinner=False)
+def create_chart(performance_df, strength_df, final_absolute_performance,
                  selected_metric, selected_tickers, chart_title, y_label, baseline,
                  all_tickers_in_market, month_separator_date=None):
-    fig, ax = plt.subplots(figsize=(16, 9))
+    # pyplot の図管理に登録されないよう Figure を直接作る（再実行のたびに図が溜まり続けるのを防ぐ）
+    fig = Figure(figsize=(16, 9), layout='constrained')
+    ax = fig.subplots()
 
-    cmap = plt.get_cmap('nipy_spectral', len(all_tickers_in_market))
-    ticker_colors = {ticker: cmap(i) for i, ticker in enumerate(all_tickers_in_market)}
+    ticker_colors = get_ticker_colors(tuple(all_tickers_in_market))
 
-    strength_df = strength_dfs.get(selected_metric)
     sorted_for_legend = final_absolute_performance.index
-
-    for ticker in sorted_for_legend:
-        if ticker not in selected_tickers or ticker not in performance_df.columns: continue
-
-        perf_series = performance_df[ticker]
-        for j in range(len(perf_series) - 1):
-            d_start, d_end = perf_series.index[j], perf_series.index[j+1]
-            y_start, y_end = perf_series.iloc[j], perf_series.iloc[j+1]
-
-            alpha = 0.6
-            if strength_df is not None and not strength_df.empty and ticker in strength_df.columns:
-                try:
-                    strength_raw = strength_df.loc[d_end, ticker]
-                    if pd.isna(strength_raw): strength_raw = 50
-                    final_strength = abs(strength_raw - 50) * 2 if (selected_metric and 'RSI' in selected_metric) else strength_raw
-                    alpha = 0.15 + (0.85 * (np.clip(final_strength, 0, 100) / 100))
-                except (KeyError, IndexError):
-                    alpha = 0.15
-
-            ax.plot([d_start, d_end], [y_start, y_end], color=ticker_colors.get(ticker, 'gray'), linewidth=2.5, alpha=alpha, zorder=2)
+    # 描画対象（選択中かつデータのある銘柄）とその順位は一度だけ求め、以降のループで使い回す
+    selected_set = set(selected_tickers)
+    # 値は銘柄(列)単位で取り出すため、列方向に連続した配列として一度だけ取り出し、列位置で参照する
+    perf_values = np.asfortranarray(performance_df.to_numpy(dtype=np.float64))
+    perf_column_pos = {ticker: i for i, ticker in enumerate(performance_df.columns)}
+    plot_tickers = [(rank, ticker) for rank, ticker in enumerate(sorted_for_legend, start=1)
+                    if ticker in selected_set and ticker in perf_column_pos]
+
+    # 全銘柄の日ごとの線分（前日→当日）を1つの LineCollection にまとめ、線分ごとの濃さは色のαで表す
+    x = mdates.date2num(performance_df.index)
+    segment_end_dates = performance_df.index[1:]
+    # 線分の濃さ(α)は、指標を線分の終点の日付に一度だけ揃えて全銘柄分まとめて求め、銘柄ごとには列を参照するだけにする
+    default_alpha = np.full(len(segment_end_dates), 0.6)
+    alpha_by_ticker = {}
+    if strength_df is not None and not strength_df.empty:
+        strength_raw = strength_df.reindex(segment_end_dates).to_numpy(dtype=np.float64, copy=True)
+        alphas = strength_to_alpha(strength_raw, bool(selected_metric and 'RSI' in selected_metric))
+        alpha_by_ticker = {ticker: alphas[:, i] for i, ticker in enumerate(strength_df.columns)}
+
+    segments, segment_alphas = [], []
+    for _, ticker in plot_tickers:
+        points = np.column_stack([x, perf_values[:, perf_column_pos[ticker]]])
+        segments.append(np.stack([points[:-1], points[1:]], axis=1))
+        segment_alphas.append(alpha_by_ticker.get(ticker, default_alpha))
+
+    if segments:
+        # 線分の色は銘柄ごとの RGBA を (銘柄数, 4) の配列にして線分数分まとめて複製し、αの列だけ差し替える
+        gray = to_rgba('gray')
+        ticker_rgba = np.array([ticker_colors.get(ticker, gray) for _, ticker in plot_tickers])
+        segment_colors = np.repeat(ticker_rgba, len(default_alpha), axis=0)
+        segment_colors[:, 3] = np.concatenate(segment_alphas)
+        ax.add_collection(LineCollection(
+            np.concatenate(segments), colors=segment_colors,
+            linewidths=2.5, capstyle='projecting', zorder=2
+        ))
+        ax.autoscale_view()
+    ax.xaxis_date()
 
     last_date = performance_df.index[-1]
-    for i, ticker in enumerate(sorted_for_legend):
-        if ticker in selected_tickers and ticker in performance_df.columns:
-            color = ticker_colors.get(ticker, 'gray')
-            ax.text(last_date + pd.DateOffset(days=1), performance_df[ticker].iloc[-1], f' {i+1}', color=color, fontsize=10, fontweight='bold', va='center', zorder=3)
+    # 順位ラベルのx位置（最終日の翌日）は全銘柄共通なので一度だけ求める
+    label_x = last_date + pd.Timedelta(days=1)
+    for rank, ticker in plot_tickers:
+        color = ticker_colors.get(ticker, 'gray')
+        ax.text(label_x, perf_values[-1, perf_column_pos[ticker]], f' {rank}', color=color, fontsize=10, fontweight='bold', va='center', zorder=3)
 
     ax.set_title(chart_title, fontsize=16)
     ax.set_ylabel(y_label)
@@ -278,21 +590,23 @@ def create_chart(performance_df, strength_dfs, final_absolute_performance,
     chart_start_date = performance_df.index[0]
     chart_end_date = performance_df.index[-1]
 
-    us_sq_dates = pd.date_range(start=chart_start_date, end=chart_end_date, freq='WOM-3FRI')
-    for sq_date in us_sq_dates: ax.axvline(x=sq_date, color='red', linestyle='--', linewidth=1.5, zorder=5)
+    # SQ日の縦線は日付ごとに axvline を引かず、市場ごとに1つの vlines（軸の上端から下端まで）にまとめる
+    us_sq_dates = get_sq_dates(chart_start_date, chart_end_date, 'WOM-3FRI')
+    if len(us_sq_dates): ax.vlines(us_sq_dates, 0, 1, transform=ax.get_xaxis_transform(), colors='red', linestyles='--', linewidth=1.5, zorder=5)
 
-    jp_sq_dates = pd.date_range(start=chart_start_date, end=chart_end_date, freq='WOM-2FRI')
-    for sq_date in jp_sq_dates: ax.axvline(x=sq_date, color='blue', linestyle='--', linewidth=1.5, zorder=5)
+    jp_sq_dates = get_sq_dates(chart_start_date, chart_end_date, 'WOM-2FRI')
+    if len(jp_sq_dates): ax.vlines(jp_sq_dates, 0, 1, transform=ax.get_xaxis_transform(), colors='blue', linestyles='--', linewidth=1.5, zorder=5)
 
     if month_separator_date: ax.axvline(x=month_separator_date, color='gray', linestyle=':', linewidth=2, zorder=5)
 
-    legend_elements = [Line2D([0], [0], color=ticker_colors.get(ticker, 'gray'), lw=4, label=f"{i+1}. {ALL_ASSETS_NAME_MAP.get(ticker, ticker)} ({ticker})") for i, ticker in enumerate(sorted_for_legend) if ticker in selected_tickers]
-    legend_elements.append(Line2D([0], [0], color='red', linestyle='--', lw=1.5, label='米国SQ日 (第3金曜)'))
-    legend_elements.append(Line2D([0], [0], color='blue', linestyle='--', lw=1.5, label='日本SQ日 (第2金曜)'))
-    if month_separator_date: legend_elements.append(Line2D([0], [0], color='gray', linestyle=':', lw=2, label='月の区切り'))
-
-    ax.legend(handles=legend_elements, bbox_to_anchor=(1.02, 1), loc='upper left', title="凡例（絶対パフォーマンス順）")
-    fig.tight_layout(rect=[0, 0, 0.85, 1])
+    legend_elements = build_legend_elements(
+        tuple(sorted_for_legend), frozenset(selected_tickers),
+        tuple(all_tickers_in_market), bool(month_separator_date)
+    )
+    legend = ax.legend(handles=list(legend_elements), bbox_to_anchor=(1.02, 1), loc='upper left', title="凡例（絶対パフォーマンス順）")
+    # 凡例は軸の右外側に置くのでレイアウト計算の対象から外し、右端15%を凡例用に空けておく
+    legend.set_in_layout(False)
+    fig.get_layout_engine().set(rect=(0, 0, 0.85, 1))
     return fig
 
 
@@ -360,26 +674,35 @@ else:
         target_tickers = ALL_JP_TICKERS + ALL_US_TICKERS
         benchmark_ticker = None
 
+    # 指標はデータ取得の前に選ばせ、VWAP系が選ばれたときだけ5分足を取得する
+    selected_metric = st.sidebar.radio('線の濃さに反映する指標', DAILY_METRICS + VWAP_METRICS, index=0)
+
     # --- ★変更点③: 新しいデータ取得・計算関数の呼び出し ---
     # period_option を渡して、データ取得戦略を制御する
-    close_prices, strength_dfs = get_data_and_indicators(
+    absolute_cumulative_returns, strength_dfs = get_data_and_indicators(
         period_option,
         pd.to_datetime(start_date),
         pd.to_datetime(end_date),
-        target_tickers
+        target_tickers,
+        include_vwap=selected_metric in VWAP_METRICS
     )
 
-    if close_prices is not None and not close_prices.empty:
-        # --- これ以降の描画・表示ロジックは変更なし ---
-        absolute_cumulative_returns = (1 + close_prices.pct_change().fillna(0)).cumprod() - 1
-        final_absolute_performance = absolute_cumulative_returns.iloc[-1].sort_values(ascending=False)
-        sorted_tickers_by_abs = final_absolute_performance.index.tolist()
+    if absolute_cumulative_returns is not None and not absolute_cumulative_returns.empty:
+        # --- ランキングの算出と描画・表示 ---
+        # 最終日のリターンの降順（同値は元の並び順、NaN は末尾）を NumPy の argsort で一度だけ求める
+        final_returns = absolute_cumulative_returns.to_numpy()[-1]
+        rank_order = np.argsort(-final_returns, kind='stable')
+        ranked_columns = absolute_cumulative_returns.columns[rank_order]
+        final_absolute_performance = pd.Series(final_returns[rank_order], index=ranked_columns, name=absolute_cumulative_returns.index[-1])
+        sorted_tickers_by_abs = ranked_columns.tolist()
 
         chart_title_suffix = f"（{title_period_text}）"
         if display_mode == '相対パフォーマンス' and benchmark_ticker:
-            if benchmark_ticker in close_prices.columns:
-                benchmark_perf = absolute_cumulative_returns[benchmark_ticker] + 1
-                performance_to_plot = (absolute_cumulative_returns + 1).divide(benchmark_perf, axis=0)
+            if benchmark_ticker in absolute_cumulative_returns.columns:
+                # 各銘柄の (1 + 累積リターン) をベンチマークの値で割る計算は、中間の DataFrame を作らず配列上で一度に行う
+                growth = absolute_cumulative_returns.to_numpy() + 1
+                benchmark_growth = growth[:, absolute_cumulative_returns.columns.get_loc(benchmark_ticker)]
+                performance_to_plot = pd.DataFrame(growth / benchmark_growth[:, None], index=absolute_cumulative_returns.index, columns=absolute_cumulative_returns.columns)
                 chart_title = f'{market_selection}市場 相対パフォーマンス {chart_title_suffix}'
                 y_label = f'市場平均 ({ALL_ASSETS_NAME_MAP.get(benchmark_ticker, benchmark_ticker)}) 比'
                 baseline = 1.0
@@ -393,13 +716,9 @@ else:
              y_label = '累積リターン (%)'
              baseline = 0.0
 
-        metric_labels = list(strength_dfs.keys())
-        if not metric_labels:
-            selected_metric = None
-        else:
-            selected_metric = st.sidebar.radio('線の濃さに反映する指標', metric_labels, index=0)
-
         all_labels = [f"{i+1}. {ALL_ASSETS_NAME_MAP.get(t, t)} ({t})" for i, t in enumerate(sorted_tickers_by_abs)]
+        # ラベルからティッカーへの対応は一度だけ作り、文字列の分解はしない
+        label_to_ticker = dict(zip(all_labels, sorted_tickers_by_abs))
 
         if 'selected_tickers' not in st.session_state or 'market_selection_memory' not in st.session_state or st.session_state.market_selection_memory != market_selection:
             st.session_state.selected_tickers = sorted_tickers_by_abs
@@ -410,9 +729,9 @@ else:
 
         cols = st.sidebar.columns(2)
         if cols[0].button('米国のみ', use_container_width=True):
-            st.session_state.selected_tickers = [t for t in sorted_tickers_by_abs if t in ALL_US_TICKERS]
+            st.session_state.selected_tickers = [t for t in sorted_tickers_by_abs if t in ALL_US_TICKERS_SET]
         if cols[1].button('日本のみ', use_container_width=True):
-            st.session_state.selected_tickers = [t for t in sorted_tickers_by_abs if t in ALL_JP_TICKERS]
+            st.session_state.selected_tickers = [t for t in sorted_tickers_by_abs if t in ALL_JP_TICKERS_SET]
 
         cols = st.sidebar.columns(2)
         if cols[0].button('すべて選択', use_container_width=True):
@@ -420,8 +739,8 @@ else:
         if cols[1].button('すべて解除', use_container_width=True):
             st.session_state.selected_tickers = []
 
-        tickers_to_select = st.session_state.get('selected_tickers', [])
-        default_labels = [label for label in all_labels if label.split('(')[-1].replace(')', '') in tickers_to_select]
+        tickers_to_select = set(st.session_state.get('selected_tickers', []))
+        default_labels = [label for label in all_labels if label_to_ticker[label] in tickers_to_select]
 
         selected_labels = st.sidebar.multiselect(
             '**表示する銘柄（絶対パフォーマンス順）**',
@@ -429,12 +748,20 @@ else:
             default=default_labels
         )
 
-        current_selected_tickers = [label.split('(')[-1].replace(')', '') for label in selected_labels]
+        current_selected_tickers = [label_to_ticker[label] for label in selected_labels]
         st.session_state.selected_tickers = current_selected_tickers
 
+        # 5分足は直近60日分しか取得できず、期間によっては例外なしに空で返るため、VWAP系の指標が表示できないことを知らせる
+        if selected_metric in VWAP_METRICS:
+            vwap_df = strength_dfs.get(selected_metric)
+            if vwap_df is None or vwap_df.isna().to_numpy().all():
+                st.warning(f"選択された期間の5分足データがないため、「{selected_metric}」は表示できません（5分足は直近60日分のみ取得できます）。線は一律の濃さで表示しています。")
+            elif pd.to_datetime(start_date) < today - pd.Timedelta(days=INTRADAY_MAX_HISTORY_DAYS):
+                st.info(f"5分足は直近60日分のみ取得できるため、「{selected_metric}」はそれより前の日付では一律の濃さで表示しています。")
+
         st.header(chart_title)
         chart_fig = create_chart(
-            performance_to_plot, strength_dfs, final_absolute_performance,
+            performance_to_plot, strength_dfs.get(selected_metric), final_absolute_performance,
             selected_metric, current_selected_tickers,
             chart_title, y_label, baseline,
             target_tickers, month_separator_date